@@ -1,205 +1,1150 @@
-import os
-import tempfile
-import requests
-import re
-from threading import Thread
-from flask import Flask
-from telegram import Update, InputMediaPhoto
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-import yt_dlp
-
-# ===============================
-# ENV
-# ===============================
-TOKEN = os.getenv("TOKEN")
-if not TOKEN:
-    raise RuntimeError("TOKEN not found in environment variables")
-
-# ===============================
-# Flask app (Render keep-alive)
-# ===============================
-app = Flask(__name__)
-
-@app.route("/")
-def home():
-    return "Shadow Extractor System is alive. Ready to raid gates. 🗡️", 200
-
-# ===============================
-# Regex URL
-# ===============================
-URL_REGEX = re.compile(r'https?://[^\s]+', re.IGNORECASE)
-
-# ===============================
-# Gate resolver
-# ===============================
-def get_gate_from_url(url: str) -> str:
-    u = url.lower()
-    if "tiktok" in u:
-        return "🟣 Purple Gate — TikTok"
-    if "instagram" in u:
-        return "🟠 Orange Gate — Instagram"
-    if "twitter" in u or "x.com" in u:
-        return "⚫ Black Gate — X"
-    if "youtube" in u or "youtu.be" in u:
-        return "🟥 Red Gate — YouTube"
-    return ""
-
-# ===============================
-# Telegram handlers
-# ===============================
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "🗡️ Shadow Extractor System activated.\n\n"
-        "Send a link from:\n"
-        "• YouTube\n"
-        "• TikTok\n"
-        "• Instagram\n"
-        "• Twitter / X\n\n"
-        "I will extract the essence.\n"
-        "Rise, Hunter."
-    )
-
-async def download_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message_text = update.message.text or ""
-    urls = URL_REGEX.findall(message_text)
-    if not urls:
-        return
-
-    url = urls[0]
-    gate_label = get_gate_from_url(url)
-    if not gate_label:
-        return  # ignora link non supportati
-
-    status_msg = await update.message.reply_text(
-        "🗡️ Opening the Gate... Extracting shadow essence."
-    )
-
-    # ===============================
-    # TikTok via API
-    # ===============================
-    if "tiktok" in url.lower():
-        await status_msg.edit_text("🟣 Entering Purple Gate... TikTok dungeon detected.")
-        try:
-            api_url = "https://www.tikwm.com/api/"
-            response = requests.get(api_url, params={"url": url}, timeout=30)
-            data = response.json()
-
-            if data.get("code") != 0:
-                raise Exception("Shadow Realm sealed")
-
-            video_data = data["data"]
-            title = video_data.get("title", "Shadow Essence").strip()
-            music_title = video_data.get("music_info", {}).get("title", "Unknown")
-
-            if video_data.get("images"):
-                await status_msg.edit_text(
-                    f"🟣 Purple Gate cleared\n📸 {len(video_data['images'])} shadows extracted"
-                )
-                media_group = [
-                    InputMediaPhoto(media=requests.get(img, timeout=30).content)
-                    for img in video_data["images"]
-                ]
-                await update.message.reply_media_group(media=media_group)
-                await status_msg.delete()
-                return
-
-            video_url = video_data.get("hdplay") or video_data.get("play")
-            video_resp = requests.get(video_url, timeout=60)
-
-            await update.message.reply_video(
-                video=video_resp.content,
-                caption=(
-                    "🟣 Purple Gate — TikTok\n"
-                    "⚔️ MAX QUALITY\n\n"
-                    f"🗡️ {title}\n"
-                    "#tiktok #shadowextractor"
-                ),
-            )
-            await status_msg.delete()
-            return
-
-        except Exception as err:
-            await status_msg.edit_text(f"❌ Gate collapsed: {str(err)[:200]}")
-            return
-
-    # ===============================
-    # Everything else via yt-dlp
-    # ===============================
-    await status_msg.edit_text("🗡️ Attempting MAX QUALITY extraction...")
-
-    ydl_opts_high = {
-        "format": "bestvideo+bestaudio/best",
-        "noplaylist": True,
-        "merge_output_format": "mp4",
-        "quiet": True,
-        "no_warnings": True,
-        "retries": 3,
-        "user_agent": "Mozilla/5.0",
-        "cookiefile": "cookies.txt",
-    }
-
-    with tempfile.TemporaryDirectory() as tmpdir:
-        ydl_opts_high["outtmpl"] = os.path.join(tmpdir, "%(title)s.%(ext)s")
-
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts_high) as ydl:
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
-            quality_note = "MAX QUALITY"
-        except:
-            await status_msg.edit_text("⚠️ MAX QUALITY blocked — falling back.")
-            ydl_opts_safe = {
-                "format": "best[height<=720]/best",
-                "noplaylist": True,
-                "merge_output_format": "mp4",
-                "quiet": True,
-                "no_warnings": True,
-                "retries": 3,
-                "user_agent": "Mozilla/5.0",
-            }
-            ydl_opts_safe["outtmpl"] = os.path.join(tmpdir, "%(title)s.%(ext)s")
-            with yt_dlp.YoutubeDL(ydl_opts_safe) as ydl:
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
-            quality_note = "HIGH QUALITY (fallback)"
-
-        title = info.get("title", "Unknown Essence")
-        height = info.get("height")
-        tags = info.get("tags") or []
-        tags_text = " ".join(f"#{t.replace(' ', '')}" for t in tags[:5])
-
-        caption = f"{gate_label}\n⚔️ {quality_note}"
-        if height:
-            caption += f" • {height}p"
-        caption += (
-            f"\n\n🗡️ {title}\n\n"
-            f"{tags_text}\n"
-            "#shadowextractor #hunter"
-        )
-
-        await status_msg.edit_text("⚔️ Extraction complete. Delivering the loot...")
-
-        with open(filename, "rb") as video_file:
-            await update.message.reply_video(
-                video=video_file,
-                caption=caption,
-            )
-
-        await status_msg.delete()
-
-# ===============================
-# Startup
-# ===============================
-def run_flask():
-    port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
-
-if __name__ == "__main__":
-    Thread(target=run_flask, daemon=True).start()
-
-    tg_app = Application.builder().token(TOKEN).build()
-    tg_app.add_handler(CommandHandler("start", start))
-    tg_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, download_video))
-
-    print("Shadow Extractor System online... Ready to raid gates. 🗡️")
-    tg_app.run_polling()
+import os
+import asyncio
+import tempfile
+import shutil
+from pathlib import Path
+import httpx
+import orjson
+import re
+import copy
+import time
+import threading
+import signal
+import hashlib
+import hmac
+import functools
+import multiprocessing
+import logging
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor
+from telegram import Update, InputMediaPhoto
+from telegram.constants import MediaGroupLimit
+from telegram.error import BadRequest, TelegramError, TimedOut
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+import yt_dlp
+
+# ===============================
+# ENV
+# ===============================
+TOKEN = os.getenv("TOKEN")
+if not TOKEN:
+    raise RuntimeError("TOKEN not found in environment variables")
+
+log = logging.getLogger("shadowextractor")
+
+# Bot API server locale (telegram-bot-api --local) sullo stesso filesystem:
+# upload fino a 2 GB e file passati per percorso invece che in memoria
+BOT_API_URL = os.getenv("BOT_API_URL", "").rstrip("/")
+
+# ===============================
+# Keep-alive endpoint (Render) + webhook, sullo stesso event loop del bot
+# ===============================
+HOME_TEXT = "Shadow Extractor System is alive. Ready to raid gates. 🗡️"
+
+# con un URL pubblico Telegram spinge gli update qui invece del long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = hashlib.sha256(TOKEN.encode()).hexdigest()
+
+def http_response(status: str, body: bytes = b"", head_only: bool = False) -> bytes:
+    head = (
+        f"HTTP/1.1 {status}\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode()
+    return head if head_only else head + body
+
+# il ping di Render è la richiesta più frequente: risposta pronta in byte
+HOME_RESPONSE = http_response("200 OK", HOME_TEXT.encode())
+HOME_HEAD_RESPONSE = http_response("200 OK", HOME_TEXT.encode(), head_only=True)
+
+WEBHOOK_MAX_BODY = 1024 * 1024  # un update è qualche KB: oltre è spazzatura
+
+async def handle_webhook(application: Application, reader: asyncio.StreamReader, headers: dict) -> bytes:
+    # secret prima del corpo: chi non lo conosce non ci fa leggere nulla
+    secret = headers.get("x-telegram-bot-api-secret-token", "").encode("latin-1")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET.encode()):
+        return http_response("403 Forbidden")
+    length = int(headers.get("content-length", "0"))
+    if not 0 <= length <= WEBHOOK_MAX_BODY:
+        return http_response("413 Payload Too Large")
+    payload = await asyncio.wait_for(reader.readexactly(length), timeout=10)
+    try:
+        update = Update.de_json(orjson.loads(payload), application.bot)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return http_response("400 Bad Request")
+    await application.update_queue.put(update)
+    return http_response("200 OK")
+
+async def handle_http(application: Application, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=10)
+        lines = request.decode("latin-1").split("\r\n")
+        method, path = lines[0].split(" ")[:2]
+        headers = {
+            k.strip().lower(): v.strip()
+            for k, _, v in (line.partition(":") for line in lines[1:] if line)
+        }
+        if method == "POST" and path == WEBHOOK_PATH:
+            response = await handle_webhook(application, reader, headers)
+        else:
+            response = HOME_HEAD_RESPONSE if method == "HEAD" else HOME_RESPONSE
+        writer.write(response)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+# ===============================
+# Work dir (RAM-backed when possible)
+# ===============================
+SHM_DIR = "/dev/shm"
+SHM_MIN_FREE = 256 * 1024 * 1024
+
+# /dev/shm tiene download e merge in RAM; se manca o è quasi pieno si usa il disco
+def get_work_dir() -> str:
+    work_dir = os.getenv("WORK_DIR")
+    if work_dir:
+        return work_dir
+    if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+        if shutil.disk_usage(SHM_DIR).free >= SHM_MIN_FREE:
+            return SHM_DIR
+    return tempfile.gettempdir()
+
+# stat, mkdir e rmtree girano nel thread di default di asyncio: brevi, ma su un
+# disco lento bloccherebbero il loop per tutte le chat (e il DL_POOL può essere
+# occupato dai download)
+STAGING_NAME = "shadowextractor"
+STAGING_MAX_AGE = 3600  # job rimasti da un crash: via dopo un'ora
+
+# una cartella di staging fissa per radice, una sottocartella per richiesta
+def make_job_dir() -> str:
+    staging = os.path.join(get_work_dir(), STAGING_NAME)
+    os.makedirs(staging, exist_ok=True)
+    return tempfile.mkdtemp(dir=staging)
+
+def discard(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def prune_staging():
+    cutoff = time.time() - STAGING_MAX_AGE
+    for root in {os.getenv("WORK_DIR") or SHM_DIR, tempfile.gettempdir()}:
+        try:
+            entries = list(os.scandir(os.path.join(root, STAGING_NAME)))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    discard(entry.path)
+            except OSError:
+                pass
+
+async def staging_janitor():
+    while True:
+        await asyncio.to_thread(prune_staging)
+        await asyncio.sleep(STAGING_MAX_AGE)
+
+# task di sottofondo (pulizie): il riferimento evita che il GC li interrompa
+BACKGROUND: set = set()
+
+def in_background(coro):
+    task = asyncio.create_task(coro)
+    BACKGROUND.add(task)
+    task.add_done_callback(BACKGROUND.discard)
+
+# ===============================
+# HTTP client (async, keep-alive pool)
+# ===============================
+HTTP = httpx.AsyncClient(
+    timeout=30,
+    follow_redirects=True,
+    # stesso user agent di yt-dlp: alcune CDN rifiutano "python-httpx"
+    headers={"User-Agent": "Mozilla/5.0"},
+    # con un transport esplicito i limiti vanno passati a lui, non al client.
+    # retries ripete solo gli errori di connessione: niente richieste doppie
+    # HTTP/2: API tikwm e immagini della stessa CDN multiplexate su una connessione
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        # httpx chiude le connessioni inattive dopo 5 s: troppo poco tra un link e l'altro
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=20,
+            keepalive_expiry=60,
+        ),
+    ),
+)
+
+# HEAD (di default senza header extra, come farà Telegram): dimensione se è un video
+async def head_video_size(url: str, headers: dict = None):
+    try:
+        resp = await HTTP.head(url, headers=headers)
+    except httpx.HTTPError:
+        return None
+    if resp.status_code != 200 or not resp.headers.get("content-type", "").startswith("video/"):
+        return None
+    length = resp.headers.get("content-length", "")
+    return int(length) if length.isdigit() else None
+
+# ===============================
+# Download a range paralleli (file progressivi)
+# ===============================
+RANGE_PARTS = 8
+RANGE_MIN_SIZE = 8 * 1024 * 1024  # sotto questa soglia una GET sola basta
+
+# client separato in HTTP/1.1: su HTTP/2 le 8 GET finirebbero multiplexate su
+# una sola connessione TCP, che è proprio il limite da aggirare
+RANGE_HTTP = httpx.AsyncClient(
+    timeout=30,
+    follow_redirects=True,
+    headers={"User-Agent": "Mozilla/5.0"},
+    transport=httpx.AsyncHTTPTransport(
+        retries=3,
+        limits=httpx.Limits(
+            max_connections=4 * RANGE_PARTS,
+            max_keepalive_connections=RANGE_PARTS,
+            keepalive_expiry=60,
+        ),
+    ),
+)
+
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+class RangeNotSupported(Exception):
+    pass
+
+async def parallel_download(url: str, path: str, size: int, headers: dict):
+    chunk = -(-size // RANGE_PARTS)
+    fd = await asyncio.to_thread(os.open, path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o644)
+    try:
+        # extent contiguo allocato in una sola syscall; ftruncate dove manca
+        if hasattr(os, "posix_fallocate"):
+            await asyncio.to_thread(os.posix_fallocate, fd, 0, size)
+        else:
+            await asyncio.to_thread(os.ftruncate, fd, size)
+
+        async def fetch_range(start: int, end: int):
+            range_headers = {**headers, "Range": f"bytes={start}-{end}"}
+            async with RANGE_HTTP.stream("GET", url, headers=range_headers, timeout=120) as resp:
+                if resp.status_code != 206:
+                    raise RangeNotSupported(f"HTTP {resp.status_code}")
+                # "bytes a-b/TOTAL": un totale diverso vuol dire un altro file
+                content_range = resp.headers.get("content-range", "")
+                match = CONTENT_RANGE_RE.fullmatch(content_range.strip())
+                if not match or tuple(map(int, match.groups())) != (start, end, size):
+                    raise RangeNotSupported(content_range or "no Content-Range")
+                pos = start
+                async for data in resp.aiter_bytes(1 << 16):
+                    # pwrite da 64 KB su tmpfs/page cache: trascurabile per il loop
+                    os.pwrite(fd, data, pos)
+                    pos += len(data)
+                if pos != end + 1:
+                    raise httpx.HTTPError(f"short range {start}-{end}")
+
+        async with asyncio.TaskGroup() as group:
+            for start in range(0, size, chunk):
+                group.create_task(fetch_range(start, min(start + chunk, size) - 1))
+    finally:
+        os.close(fd)
+
+# True se il formato scelto è un file progressivo scaricato a range; altrimenti
+# (merge audio+video, HLS/DASH, range rifiutati) se ne occupa yt-dlp
+async def fetch_ranged(info: dict, filename: str) -> bool:
+    if info.get("requested_formats") or not info.get("url"):
+        return False
+    if info.get("protocol") not in ("http", "https"):
+        return False
+
+    headers = info.get("http_headers") or {}
+    size = info.get("filesize") or await head_video_size(info["url"], headers)
+    if not size or size < RANGE_MIN_SIZE:
+        return False
+    # la dimensione dalla HEAD non passa da yt-dlp: fermarsi prima di scaricare
+    if size > UPLOAD_LIMIT:
+        raise TooLarge(size)
+
+    done = False
+    try:
+        await parallel_download(info["url"], filename, size, headers)
+        done = True
+    # OSError: fallocate/pwrite (disco pieno); si riprova con yt-dlp
+    except* (RangeNotSupported, httpx.HTTPError, OSError):
+        pass
+    if not done:
+        await asyncio.to_thread(discard, filename)
+    return done
+
+# ===============================
+# Gates + regex URL
+# ===============================
+GATES = {
+    "tiktok": "🟣 Purple Gate — TikTok",
+    "instagram": "🟠 Orange Gate — Instagram",
+    "x": "⚫ Black Gate — X",
+    "youtube": "🟥 Red Gate — YouTube",
+}
+
+# estrazione URL e controllo dominio in un solo passaggio: il gruppo che
+# fa match è la chiave del gate. Etichette host ASCII e lunghe al massimo
+# 63 caratteri come nel DNS; il testo di un messaggio è già limitato a 4096
+URL_REGEX = re.compile(
+    r"https?://(?:[a-z0-9-]{1,63}\.)*(?:"
+    r"(?P<tiktok>tiktok\.com)"
+    r"|(?P<instagram>instagram\.com|instagr\.am)"
+    r"|(?P<x>twitter\.com|x\.com)"
+    r"|(?P<youtube>youtube\.com|youtu\.be)"
+    r")(?:[/:?#]\S*)?(?!\S)",
+    # ASCII: con IGNORECASE Unicode il segno Kelvin (U+212A) varrebbe "k"
+    re.IGNORECASE | re.ASCII,
+)
+
+# ===============================
+# URL canonicalization
+# ===============================
+TRACKING_PARAMS = {
+    "si", "feature", "pp", "igsh", "igshid", "ref", "ref_src", "s", "t",
+    "is_from_webapp", "sender_device", "sender_web_id", "share_app_id",
+}
+
+YOUTUBE_HOSTS = {"youtube.com", "www.youtube.com", "m.youtube.com"}
+
+# stesso contenuto -> stessa chiave: via parametri di tracking, frammento e
+# slash finale; youtu.be/ID e shorts/ID diventano youtube.com/watch?v=ID
+def canonical_url(url: str) -> str:
+    parts = urlsplit(url)
+    netloc = parts.netloc.lower()
+    path = parts.path.rstrip("/") or "/"
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and not k.startswith("utm_")
+    ]
+    if netloc in ("youtu.be", "www.youtu.be") and path != "/":
+        query.insert(0, ("v", path[1:]))
+        netloc, path = "www.youtube.com", "/watch"
+    elif netloc in YOUTUBE_HOSTS:
+        netloc = "www.youtube.com"
+        if path.startswith("/shorts/"):
+            query.insert(0, ("v", path[len("/shorts/"):]))
+            path = "/watch"
+    return urlunsplit((
+        parts.scheme.lower(),
+        netloc,
+        path,
+        urlencode(query),
+        "",
+    ))
+
+# ===============================
+# yt-dlp (blocking, run off the event loop)
+# ===============================
+DL_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="ytdlp")
+
+async def in_dl_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DL_POOL, func, *args)
+
+# l'estrazione (interprete JS di YouTube, parsing delle pagine) è CPU e tiene
+# il GIL: gira in processi separati. "spawn" perché il padre ha già thread ed
+# event loop, e un fork li copierebbe a metà
+# worker in più per la gara TikTok: la probe che perde contro tikwm non si
+# può interrompere e tiene occupato il suo processo fino alla fine
+PROBE_WORKERS = int(os.getenv("PROBE_WORKERS", "3"))
+
+def new_probe_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=PROBE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+
+PROBE_POOL = new_probe_pool()
+
+async def in_probe_pool(func, *args):
+    global PROBE_POOL
+    pool = PROBE_POOL
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenExecutor:
+        # un worker morto (OOM, segfault) rompe il pool per sempre: se ne crea
+        # uno nuovo una volta sola, anche se le richieste fallite sono tante
+        if PROBE_POOL is pool:
+            PROBE_POOL = new_probe_pool()
+            pool.shutdown(wait=False)
+        raise
+
+# senza ffmpeg yt-dlp non può unire video+audio: meglio saperlo all'avvio che
+# sprecare un tentativo MAX QUALITY per ogni link
+HAS_FFMPEG = shutil.which("ffmpeg") is not None
+
+# frammenti HLS/DASH in parallelo; chunk da 10 MB per le GET lunghe che
+# YouTube rallenta. Sui formati progressivi piccoli non cambiano nulla
+YDL_FRAGMENTS = int(os.getenv("YDL_FRAGMENTS", "8"))
+YDL_CHUNK_SIZE = 10 * 1024 * 1024
+
+# limite di upload dei bot: 50 MB sul cloud, 2 GB con il Bot API server locale.
+# max_filesize ferma solo le singole risposte HTTP oltre il limite: le due metà
+# di un merge e i frammenti HLS/DASH passano, il file finale va ricontrollato
+UPLOAD_LIMIT = (2000 if BOT_API_URL else 50) * 1024 * 1024
+
+class TooLarge(Exception):
+    pass
+
+# errori attesi da estrazione e download (anche un worker della probe morto):
+# tutto il resto è un bug e deve arrivare al log di PTB
+GATE_ERRORS = (yt_dlp.utils.YoutubeDLError, httpx.HTTPError, OSError, TooLarge, BrokenExecutor)
+
+YDL_OPTS_HIGH = {
+    "format": "bestvideo+bestaudio/best" if HAS_FFMPEG else "best",
+    "noplaylist": True,
+    "merge_output_format": "mp4",
+    "quiet": True,
+    "no_warnings": True,
+    "retries": 3,
+    "concurrent_fragment_downloads": YDL_FRAGMENTS,
+    "http_chunk_size": YDL_CHUNK_SIZE,
+    "max_filesize": UPLOAD_LIMIT,
+    "user_agent": "Mozilla/5.0",
+    "cookiefile": "cookies.txt",
+    "outtmpl": "%(title)s.%(ext)s",
+}
+
+YDL_OPTS_SAFE = {
+    "format": "best[height<=720]/best",
+    "noplaylist": True,
+    "merge_output_format": "mp4",
+    "quiet": True,
+    "no_warnings": True,
+    "retries": 3,
+    "concurrent_fragment_downloads": YDL_FRAGMENTS,
+    "http_chunk_size": YDL_CHUNK_SIZE,
+    "max_filesize": UPLOAD_LIMIT,
+    "user_agent": "Mozilla/5.0",
+    "outtmpl": "%(title)s.%(ext)s",
+}
+
+# un YoutubeDL per thread del pool e per set di opzioni: costruirlo costa
+# (estrattori, cookie jar, handler HTTP) e un'istanza non va condivisa tra thread
+_ydl_local = threading.local()
+
+# yt-dlp legge il cookiefile una volta sola: se il file cambia (cookie
+# rinnovati) l'istanza va ricostruita, altrimenti resta quella
+def cookie_stamp(opts: dict):
+    path = opts.get("cookiefile")
+    try:
+        return os.stat(path).st_mtime_ns if path else None
+    except OSError:
+        return None
+
+def get_ydl(opts: dict) -> yt_dlp.YoutubeDL:
+    instances = getattr(_ydl_local, "instances", None)
+    if instances is None:
+        instances = _ydl_local.instances = {}
+    stamp = cookie_stamp(opts)
+    cached = instances.get(id(opts))
+    if cached is None or cached[1] != stamp:
+        # niente close() sulla vecchia: riscriverebbe i cookie vecchi sul file nuovo
+        cached = instances[id(opts)] = (yt_dlp.YoutubeDL(opts), stamp)
+    return cached[0]
+
+# estrattori yt-dlp per gate: TikTok e Twitter stanno in fondo a una lista di
+# ~1700 estrattori che altrimenti viene scorsa regex per regex a ogni probe
+GATE_EXTRACTORS = {
+    "tiktok": ("TikTok", "TikTokVM"),
+    "instagram": ("Instagram",),
+    "x": ("Twitter",),
+    "youtube": ("Youtube",),
+}
+
+def probe_ytdlp(opts: dict, url: str, gate: str = None) -> dict:
+    # estrazione completa senza download: i redirect (risultati "url") vengono
+    # risolti qui una volta sola, i passi successivi ri-selezionano solo il formato
+    ydl = get_ydl(opts)
+    for ie_key in GATE_EXTRACTORS.get(gate, ()):
+        if ydl.get_info_extractor(ie_key).suitable(url):
+            return ydl.extract_info(url, download=False, ie_key=ie_key)
+    # URL insolito per il gate (profili, foto, shorts di altri tipi): catena completa
+    return ydl.extract_info(url, download=False)
+
+def probe_isolated(url: str, gate: str = None) -> dict:
+    # eseguita nel processo worker: le opzioni sono quelle del modulo lì
+    # importato, così get_ydl riusa la stessa istanza tra una probe e l'altra.
+    # sanitize_info rende il risultato serializzabile (come --load-info-json)
+    try:
+        return yt_dlp.YoutubeDL.sanitize_info(probe_ytdlp(YDL_OPTS_HIGH, url, gate))
+    except yt_dlp.utils.YoutubeDLError as e:
+        # l'originale porta con sé logger e traceback non serializzabili
+        raise yt_dlp.utils.DownloadError(str(e)) from None
+
+# chiavi che yt-dlp aggiunge all'info per una selezione video+audio
+MERGE_KEYS = (
+    "requested_formats", "format", "format_id", "ext", "protocol", "language",
+    "format_note", "filesize_approx", "tbr", "width", "height", "resolution",
+    "fps", "dynamic_range", "vcodec", "vbr", "stretched_ratio", "aspect_ratio",
+    "acodec", "abr", "asr", "audio_channels",
+)
+
+# la probe ha già scelto il formato con YDL_OPTS_HIGH e lo ha copiato in cima
+# all'info: ri-selezionando così com'è, requested_formats resterebbe quello
+# vecchio e il fallback scaricherebbe di nuovo gli stessi stream. Copia senza
+def unselected(probed: dict) -> dict:
+    info = copy.deepcopy(probed)
+    if info.get("requested_formats"):
+        keys = MERGE_KEYS
+    else:
+        # senza "formats" l'info è il formato stesso: niente da togliere
+        keys = next(
+            (list(fmt) for fmt in info.get("formats") or () if fmt.get("format_id") == info.get("format_id")),
+            (),
+        )
+    for key in keys:
+        info.pop(key, None)
+    info.pop("requested_downloads", None)
+    return info
+
+def download_ytdlp(opts: dict, probed: dict, workdir: str):
+    # riusa il risultato della probe invece di ri-estrarre l'URL; la copia
+    # lascia intatta la probe per un eventuale fallback
+    ydl = get_ydl(opts)
+    ydl.params["paths"] = {"home": workdir}
+    info = ydl.process_ie_result(unselected(probed), download=True)
+    return info, ydl.prepare_filename(info)
+
+# contenuti dietro login: riprovare senza cookie è inutile
+LOGIN_REQUIRED_RE = re.compile(r"sign in to confirm|login required|--cookies", re.IGNORECASE)
+TOO_LARGE_TEXT = (
+    "🪨 This loot is too heavy to carry.\n"
+    f"Telegram bots can only upload up to {UPLOAD_LIMIT // (1024 * 1024)} MB."
+)
+LOGIN_HELP_TEXT = (
+    "🔒 This gate is sealed behind a login.\n"
+    "The content needs an account (or fresh cookies.txt) to be extracted."
+)
+
+# Telegram scarica da sé gli URL fino a 20 MB: basta un mp4 progressivo (audio+video)
+TELEGRAM_URL_LIMIT = 20 * 1024 * 1024
+
+DIRECT_CANDIDATES = 5
+DIRECT_PENDING_TEXT = "⏳ Telegram is still hauling the loot. It should appear shortly."
+
+# i formati della probe sono già ordinati da yt-dlp dal peggiore al migliore
+def direct_candidates(probed: dict) -> list:
+    candidates = []
+    for fmt in reversed(probed.get("formats") or [probed]):
+        if (
+            fmt.get("url")
+            and fmt.get("ext") == "mp4"
+            and fmt.get("protocol") in ("http", "https")
+            and fmt.get("vcodec") != "none"
+            and fmt.get("acodec") != "none"
+        ):
+            candidates.append(fmt)
+            if len(candidates) == DIRECT_CANDIDATES:
+                break
+    return candidates
+
+# HEAD senza gli header di yt-dlp: Telegram scaricherà l'URL così, e un
+# formato che li richiede deve risultare inservibile già qui
+async def format_size(fmt: dict):
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size is None:
+        size = await head_video_size(fmt["url"])
+    return size
+
+PROBE_TTL = 600
+PROBE_CACHE_SIZE = 512
+PROBE_CACHE: dict = {}  # canonical url -> (scadenza, risultato probe)
+
+async def probe_cached(url: str, gate: str = None) -> dict:
+    now = time.monotonic()
+    hit = PROBE_CACHE.get(url)
+    if hit and hit[0] > now:
+        # process_ie_result modifica il dict: si lavora su una copia
+        return copy.deepcopy(hit[1])
+
+    probed = await in_probe_pool(probe_isolated, url, gate)
+
+    for key in [k for k, (exp, _) in PROBE_CACHE.items() if exp <= now]:
+        del PROBE_CACHE[key]
+    while len(PROBE_CACHE) >= PROBE_CACHE_SIZE:
+        del PROBE_CACHE[next(iter(PROBE_CACHE))]
+    PROBE_CACHE[url] = (now + PROBE_TTL, copy.deepcopy(probed))
+    return probed
+
+# None se anche un solo formato scelto non dichiara la dimensione
+def selected_size(info: dict):
+    total = 0
+    for fmt in info.get("requested_formats") or [info]:
+        size = fmt.get("filesize") or fmt.get("filesize_approx")
+        if not size:
+            return None
+        total += size
+    return total
+
+def select_ytdlp(opts: dict, probed: dict, workdir: str):
+    # solo selezione del formato, senza scaricare
+    ydl = get_ydl(opts)
+    ydl.params["paths"] = {"home": workdir}
+    info = ydl.process_ie_result(unselected(probed), download=False)
+    return info, ydl.prepare_filename(info)
+
+# legge il file e lo elimina subito: durante l'upload resta una sola copia
+# (importante se il work dir è /dev/shm, dove il file occupa già RAM)
+def file_size(path: str):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+def take_file(path: str) -> bytes:
+    data = Path(path).read_bytes()
+    os.remove(path)
+    return data
+
+def run_ytdlp(opts: dict, url: str, workdir: str):
+    ydl = get_ydl(opts)
+    ydl.params["paths"] = {"home": workdir}
+    info = ydl.extract_info(url, download=True)
+    return info, ydl.prepare_filename(info)
+
+# ===============================
+# TikTok API (tikwm)
+# ===============================
+TIKWM_API = "https://www.tikwm.com/api/"
+
+async def fetch_tikwm(url: str) -> dict:
+    response = await HTTP.get(TIKWM_API, params={"url": url})
+    data = orjson.loads(response.content)
+
+    if data.get("code") != 0:
+        raise Exception("Shadow Realm sealed")
+
+    return data["data"]
+
+# DNS, TCP e TLS verso tikwm all'avvio: il primo TikTok trova la connessione pronta
+async def warm_tikwm():
+    try:
+        await HTTP.head(TIKWM_API, timeout=5)
+    except httpx.HTTPError:
+        pass  # solo un'ottimizzazione: se fallisce, ci pensa la prima richiesta
+
+# (task, result) del primo task che termina senza errori; gli altri vengono cancellati
+async def first_success(*tasks: asyncio.Task):
+    pending = set(tasks)
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                for other in pending:
+                    other.cancel()
+                return task, task.result()
+            error = task.exception()
+    raise error
+
+# ===============================
+# Caption
+# ===============================
+def build_caption(gate_label: str, quality_note: str, info: dict) -> str:
+    title = info.get("title", "Unknown Essence")
+    height = info.get("height")
+    tags = info.get("tags") or []
+    tags_text = " ".join(f"#{t.replace(' ', '')}" for t in tags[:5])
+
+    caption = f"{gate_label}\n⚔️ {quality_note}"
+    if height:
+        caption += f" • {height}p"
+    caption += (
+        f"\n\n🗡️ {title}\n\n"
+        f"{tags_text}\n"
+        "#shadowextractor #hunter"
+    )
+    return caption
+
+# ===============================
+# Delivery (file_id riusabili)
+# ===============================
+# ("video", file_id, caption) | ("photos", [file_id, ...], None)
+def delivery_from_video(sent, caption: str):
+    media = sent.video or sent.animation or sent.document
+    return ("video", media.file_id, caption) if media else None
+
+# PTB 20.7 usa 20s di write timeout fisso per gli upload multipart,
+# ignorando quello del builder: va passato a ogni invio con file
+UPLOAD_TIMEOUT = 600
+
+# sendMediaGroup vuole da 2 a 10 elementi: gruppi bilanciati (11 -> 6+5),
+# mai un album da uno; una foto sola va con sendPhoto
+def album_chunks(items: list) -> list:
+    if not items:
+        return []
+    groups = -(-len(items) // MediaGroupLimit.MAX_MEDIA_LENGTH)
+    size, extra = divmod(len(items), groups)
+    chunks, i = [], 0
+    for g in range(groups):
+        n = size + (g < extra)
+        chunks.append(items[i:i + n])
+        i += n
+    return chunks
+
+# photos: URL, byte o file_id
+async def send_album(message, photos: list) -> list:
+    sent = []
+    for chunk in album_chunks(photos):
+        if len(chunk) < MediaGroupLimit.MIN_MEDIA_LENGTH:
+            sent.append(await message.reply_photo(
+                photo=chunk[0],
+                read_timeout=UPLOAD_TIMEOUT,
+                write_timeout=UPLOAD_TIMEOUT,
+            ))
+            continue
+        sent.extend(await message.reply_media_group(
+            media=[InputMediaPhoto(media=p) for p in chunk],
+            read_timeout=UPLOAD_TIMEOUT,
+            write_timeout=UPLOAD_TIMEOUT,
+        ))
+    return sent
+
+# Telegram scarica da sé le immagini; il gruppo di cui rifiuta un URL
+# (formato, CDN) viene scaricato qui e caricato come byte
+async def send_images(message, urls: list) -> list:
+    sent = []
+    for chunk in album_chunks(urls):
+        try:
+            sent.extend(await send_album(message, chunk))
+        except BadRequest:
+            async with asyncio.TaskGroup() as group:
+                fetches = [group.create_task(HTTP.get(u)) for u in chunk]
+            sent.extend(await send_album(message, [f.result().content for f in fetches]))
+    return sent
+
+def delivery_from_photos(sent: list):
+    return ("photos", [m.photo[-1].file_id for m in sent if m.photo], None)
+
+async def send_delivery(message, delivery):
+    kind, file_ids, caption = delivery
+    if kind == "video":
+        await message.reply_video(video=file_ids, caption=caption)
+    else:
+        await send_album(message, file_ids)
+
+# ===============================
+# Messaggio di stato (edit limitati)
+# ===============================
+STATUS_MIN_INTERVAL = 0.8  # Telegram tollera circa un edit al secondo per chat
+
+class StatusMessage:
+    def __init__(self, msg):
+        self.msg = msg
+        self.text = msg.text
+        self.last = time.monotonic()
+        self.pending = None  # edit rimandato dal limite di frequenza
+
+    async def set(self, text: str, force: bool = False):
+        # un nuovo stato supera quello ancora in attesa
+        self.cancel_pending()
+        # stesso testo: Telegram risponde "message is not modified" e il giro è perso
+        if text == self.text:
+            return
+        wait = STATUS_MIN_INTERVAL - (time.monotonic() - self.last)
+        if not force and wait > 0:
+            # rimandato, non perso: se nel frattempo non arriva altro, va mostrato
+            self.pending = asyncio.create_task(self.edit_later(text, wait))
+            return
+        await self.edit(text)
+
+    async def edit_later(self, text: str, wait: float):
+        await asyncio.sleep(wait)
+        await self.edit(text)
+
+    async def edit(self, text: str):
+        try:
+            await self.msg.edit_text(text)
+        except BadRequest:
+            return
+        except TelegramError as err:
+            # RetryAfter, TimedOut, NetworkError: lo stato è solo cosmetico, e
+            # dall'edit rimandato nessuno raccoglierebbe l'eccezione
+            log.warning("status edit failed: %s", err)
+            return
+        self.text, self.last = text, time.monotonic()
+
+    def cancel_pending(self):
+        if self.pending:
+            self.pending.cancel()
+            self.pending = None
+
+    async def delete(self):
+        self.cancel_pending()
+        await self.msg.delete()
+
+# richieste in corso per URL canonico: chi arriva dopo aspetta la prima
+INFLIGHT: dict = {}
+
+# consegne riuscite per URL canonico (LRU): un link già visto si rimanda per
+# file_id, senza scaricare né caricare nulla. Salvate su disco allo shutdown
+DELIVERY_CACHE_SIZE = 5000
+DELIVERY_CACHE_FILE = os.getenv("DELIVERY_CACHE_FILE", "deliveries.json")
+DELIVERIES: OrderedDict = OrderedDict()
+
+def remember_delivery(url: str, delivery):
+    DELIVERIES[url] = delivery
+    DELIVERIES.move_to_end(url)
+    while len(DELIVERIES) > DELIVERY_CACHE_SIZE:
+        DELIVERIES.popitem(last=False)
+
+def load_deliveries():
+    try:
+        entries = orjson.loads(Path(DELIVERY_CACHE_FILE).read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return
+    for url, delivery in entries:
+        remember_delivery(url, tuple(delivery))
+
+def save_deliveries():
+    tmp = DELIVERY_CACHE_FILE + ".tmp"
+    Path(tmp).write_bytes(orjson.dumps(list(DELIVERIES.items())))
+    os.replace(tmp, DELIVERY_CACHE_FILE)
+
+# ===============================
+# Telegram handlers
+# ===============================
+# file piccolo con URL diretto: Telegram lo scarica lato server, il bot non
+# scarica né ricarica nulla. None se non applicabile o se Telegram rifiuta l'URL
+# stesso formato o almeno stessa altezza (chiavi mancanti non contano)
+def same_quality(fmt: dict, info: dict) -> bool:
+    for key in ("format_id", "height"):
+        if fmt.get(key) is not None and fmt.get(key) == info.get(key):
+            return True
+    return False
+
+# info: la selezione di YDL_OPTS_HIGH; il link diretto non deve valere meno
+async def send_direct(message, gate: str, gate_label: str, probed: dict, info: dict):
+    if gate == "youtube":
+        return None  # gli URL googlevideo sono legati all'IP di chi ha fatto la probe
+
+    candidates = [fmt for fmt in direct_candidates(probed) if same_quality(fmt, info)]
+    # dimensioni ignote: HEAD in parallelo sui candidati, un solo round-trip;
+    # vince il migliore che sta nel limite
+    sizes = await asyncio.gather(*(format_size(fmt) for fmt in candidates))
+    direct = next(
+        (
+            {**probed, **fmt}
+            for fmt, size in zip(candidates, sizes)
+            if size and size <= TELEGRAM_URL_LIMIT
+        ),
+        None,
+    )
+    if direct is None:
+        return None
+
+    caption = build_caption(gate_label, "DIRECT LINK", direct)
+    # Telegram scarica fino a 20 MB da un altro server: serve più del read
+    # timeout di default. TimedOut non è BadRequest e risale a open_gate
+    try:
+        sent = await message.reply_video(
+            video=direct["url"],
+            caption=caption,
+            read_timeout=UPLOAD_TIMEOUT,
+        )
+    except BadRequest:
+        return None
+    return delivery_from_video(sent, caption)
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "🗡️ Shadow Extractor System activated.\n\n"
+        "Send a link from:\n"
+        "• YouTube\n"
+        "• TikTok\n"
+        "• Instagram\n"
+        "• Twitter / X\n\n"
+        "I will extract the essence.\n"
+        "Rise, Hunter."
+    )
+
+async def download_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # il filtro Regex del dispatcher ha già fatto il match: niente secondo passaggio
+    m = context.matches[0]
+    gate = m.lastgroup
+    url = canonical_url(m.group(0))
+
+    cached = DELIVERIES.get(url)
+    if cached is not None:
+        DELIVERIES.move_to_end(url)
+        try:
+            await send_delivery(update.message, cached)
+            return
+        except BadRequest:
+            DELIVERIES.pop(url, None)  # file_id non più valido: si riscarica
+
+    # se il primo fallisce, uno solo di quelli in attesa riprova: gli altri
+    # trovano il suo future in INFLIGHT e aspettano lui
+    while (pending := INFLIGHT.get(url)) is not None:
+        delivery = await asyncio.shield(pending)
+        if delivery:
+            await send_delivery(update.message, delivery)
+            return
+
+    future = INFLIGHT[url] = asyncio.get_running_loop().create_future()
+    delivery = None
+    try:
+        delivery = await open_gate(update.message, gate, url)
+        if delivery:
+            remember_delivery(url, delivery)
+    finally:
+        future.set_result(delivery)
+        if INFLIGHT.get(url) is future:
+            del INFLIGHT[url]
+
+async def open_gate(message, gate: str, url: str):
+    gate_label = GATES[gate]
+
+    # il primo messaggio di stato è già quello del ramo: un round-trip in meno
+    if gate == "tiktok":
+        status_text = "🟣 Entering Purple Gate... TikTok dungeon detected."
+    else:
+        status_text = "🗡️ Opening the Gate... Attempting MAX QUALITY extraction."
+    status_msg = StatusMessage(await message.reply_text(status_text))
+
+    # ===============================
+    # TikTok: tikwm API and yt-dlp probe race, first success wins
+    # ===============================
+    probed = None
+    if gate == "tiktok":
+        tikwm_task = asyncio.create_task(fetch_tikwm(url))
+        probe_task = asyncio.create_task(probe_cached(url, gate))
+        try:
+            winner, result = await first_success(tikwm_task, probe_task)
+        except Exception as err:
+            log.warning("tiktok gate failed for %s: %s", url, err)
+            await status_msg.set(f"❌ Gate collapsed: {str(err)[:200]}", force=True)
+            return None
+
+        if winner is probe_task:
+            probed = result  # yt-dlp ha vinto: si prosegue sotto senza ri-estrarre
+        else:
+            try:
+                video_data = result
+                title = video_data.get("title", "Shadow Essence").strip()
+
+                images = video_data.get("images")
+                if images:
+                    sent = await send_images(message, images)
+                    await status_msg.delete()
+                    return delivery_from_photos(sent)
+
+                hd_url = video_data.get("hdplay")
+                video_url = hd_url or video_data.get("play")
+                size = video_data.get("hd_size") if hd_url else video_data.get("size")
+
+                caption = (
+                    "🟣 Purple Gate — TikTok\n"
+                    "⚔️ MAX QUALITY\n\n"
+                    f"🗡️ {title}\n"
+                    "#tiktok #shadowextractor"
+                )
+
+                # prima si lascia scaricare a Telegram: nessun byte passa dal container
+                sent = None
+                if not size or size <= TELEGRAM_URL_LIMIT:
+                    try:
+                        sent = await message.reply_video(
+                            video=video_url,
+                            caption=caption,
+                            read_timeout=UPLOAD_TIMEOUT,
+                        )
+                    except BadRequest:
+                        pass  # URL rifiutato o scaduto: si scarica e si carica
+                    except TimedOut:
+                        # Telegram può ancora pubblicarlo: niente "Gate collapsed" né doppione
+                        log.warning("tikwm url send timed out for %s", url)
+                        await status_msg.set(DIRECT_PENDING_TEXT, force=True)
+                        return None
+
+                if sent is None:
+                    video_resp = await HTTP.get(video_url, timeout=60)
+                    sent = await message.reply_video(
+                        video=video_resp.content,
+                        caption=caption,
+                        read_timeout=UPLOAD_TIMEOUT,
+                        write_timeout=UPLOAD_TIMEOUT,
+                    )
+                await status_msg.delete()
+                return delivery_from_video(sent, caption)
+
+            except Exception as err:
+                log.warning("tikwm delivery failed for %s", url, exc_info=True)
+                await status_msg.set(f"❌ Gate collapsed: {str(err)[:200]}", force=True)
+                return None
+
+    # ===============================
+    # Everything else via yt-dlp
+    # ===============================
+    tmpdir = await asyncio.to_thread(make_job_dir)
+    high_format = None
+    try:
+        try:
+            if probed is None:
+                probed = await probe_cached(url, gate)
+            info, filename = await in_dl_pool(select_ytdlp, YDL_OPTS_HIGH, probed, tmpdir)
+            high_format = info.get("format_id")
+            try:
+                delivery = await send_direct(message, gate, gate_label, probed, info)
+            except TimedOut:
+                # il video può ancora arrivare: niente fallback, sarebbe un doppione
+                log.warning("direct link timed out for %s", url)
+                await status_msg.set(DIRECT_PENDING_TEXT, force=True)
+                return None
+            if delivery:
+                await status_msg.delete()
+                return delivery
+            size = selected_size(info)
+            if size and size > UPLOAD_LIMIT:
+                raise TooLarge(size)  # troppo grande per Telegram: niente download
+            if not await fetch_ranged(info, filename):
+                info, filename = await in_dl_pool(download_ytdlp, YDL_OPTS_HIGH, probed, tmpdir)
+            # file assente (saltato per max_filesize) o merge/frammenti oltre il
+            # limite, che max_filesize non vede: si riprova col formato leggero
+            size = await asyncio.to_thread(file_size, filename)
+            if size is None or size > UPLOAD_LIMIT:
+                raise TooLarge(size)
+            quality_note = "MAX QUALITY"
+        except GATE_ERRORS as err:
+            log.warning("max quality failed for %s: %s", url, err)
+            if LOGIN_REQUIRED_RE.search(str(err)):
+                # il fallback non ha cookie: fallirebbe di nuovo, dopo un'altra estrazione
+                await status_msg.set(LOGIN_HELP_TEXT, force=True)
+                return None
+            await status_msg.set("⚠️ MAX QUALITY blocked — falling back.")
+            # cartella a parte: yt-dlp riprenderebbe i .part del tentativo fallito
+            safe_dir = os.path.join(tmpdir, "safe")
+            try:
+                if probed is not None:
+                    # stessa probe, formato più leggero: nessuna seconda estrazione
+                    safe_info, _ = await in_dl_pool(select_ytdlp, YDL_OPTS_SAFE, probed, safe_dir)
+                    if high_format and safe_info.get("format_id") == high_format:
+                        raise err  # lo stesso formato appena fallito: riscaricarlo non serve
+                    info, filename = await in_dl_pool(download_ytdlp, YDL_OPTS_SAFE, probed, safe_dir)
+                else:
+                    info, filename = await in_dl_pool(run_ytdlp, YDL_OPTS_SAFE, url, safe_dir)
+            except TooLarge:
+                await status_msg.set(TOO_LARGE_TEXT, force=True)
+                return None
+            except GATE_ERRORS as err:
+                log.warning("fallback failed for %s: %s", url, err)
+                await status_msg.set(f"❌ Gate collapsed: {str(err)[:200]}", force=True)
+                return None
+            quality_note = "HIGH QUALITY (fallback)"
+
+        # stesso controllo sul file del fallback
+        size = await asyncio.to_thread(file_size, filename)
+        if size is None or size > UPLOAD_LIMIT:
+            await status_msg.set(TOO_LARGE_TEXT, force=True)
+            return None
+
+        caption = build_caption(gate_label, quality_note, info)
+
+        if BOT_API_URL:
+            video = Path(filename)  # il server locale legge il file dal disco
+        else:
+            # PTB 20.7 carica comunque l'intero file in memoria: la lettura
+            # avviene nel pool così il loop non resta bloccato sul disco
+            video = await in_dl_pool(take_file, filename)
+        sent = await message.reply_video(
+            video=video,
+            filename=os.path.basename(filename),
+            caption=caption,
+            read_timeout=UPLOAD_TIMEOUT,
+            write_timeout=UPLOAD_TIMEOUT,
+        )
+
+        await status_msg.delete()
+        return delivery_from_video(sent, caption)
+    finally:
+        # la pulizia non ritarda la consegna a chi aspetta lo stesso link
+        in_background(asyncio.to_thread(discard, tmpdir))
+
+# ===============================
+# Startup
+# ===============================
+async def on_startup(application: Application):
+    await asyncio.to_thread(load_deliveries)
+    application.bot_data["janitor"] = asyncio.create_task(staging_janitor())
+    in_background(warm_tikwm())
+    port = int(os.environ.get("PORT", 10000))
+    application.bot_data["home_server"] = await asyncio.start_server(
+        functools.partial(handle_http, application), host="0.0.0.0", port=port
+    )
+
+async def on_shutdown(application: Application):
+    # la cache prima di tutto: il grace period del SIGTERM di Render è breve
+    await asyncio.to_thread(save_deliveries)
+    janitor = application.bot_data.get("janitor")
+    if janitor:
+        janitor.cancel()
+    await asyncio.gather(*BACKGROUND, return_exceptions=True)
+    server = application.bot_data.get("home_server")
+    if server:
+        server.close()
+        await server.wait_closed()
+    await HTTP.aclose()
+    await RANGE_HTTP.aclose()
+    # una probe lenta non deve trattenere lo shutdown: i worker vengono
+    # chiusi quando finiscono, senza aspettarli
+    PROBE_POOL.shutdown(wait=False, cancel_futures=True)
+
+async def run_webhook(application: Application):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with application:
+        await on_startup(application)
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+        )
+        await application.start()
+        await stop.wait()
+        await application.stop()
+        await on_shutdown(application)
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(name)s %(levelname)s %(message)s",
+        level=logging.WARNING,
+    )
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .read_timeout(30)
+        .write_timeout(30)
+        .pool_timeout(60)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if BOT_API_URL:
+        builder = (
+            builder.base_url(f"{BOT_API_URL}/bot")
+            .base_file_url(f"{BOT_API_URL}/file/bot")
+            .local_mode(True)
+        )
+    tg_app = builder.build()
+    tg_app.add_handler(CommandHandler("start", start))
+    tg_app.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND & filters.Regex(URL_REGEX), download_video
+    ))
+
+    print("Shadow Extractor System online... Ready to raid gates. 🗡️")
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(tg_app))
+    else:
+        tg_app.run_polling()  # rimuove da sé un eventuale webhook rimasto